@@ -1,11 +1,278 @@
 from pymatgen.electronic_structure.core import Spin, Orbital
-from pymatgen.io.vasp.outputs import BSVasprun
 from pymatgen.io.vasp.inputs import Kpoints, Poscar
-from functools import reduce
+from multiprocessing import Pool
+from functools import partial
+from types import SimpleNamespace
+from numba import njit
+from lxml import etree
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import tempfile
 import time
+import re
+import os
+
+
+def _reduce_band(proj_band, element_index, orbitals=False, spd=False):
+    """
+    This function sums the projected weights of a single band over the atoms
+    of each element. It is defined at the module level so that it can be
+    pickled and sent to the workers of a multiprocessing pool.
+
+    Inputs:
+    ----------
+    proj_band: (np.ndarray) Projected weights of the band with the shape
+        (natoms, nkpoints, 9)
+    element_index: (dict[str][np.ndarray]) Dictionary of the form
+        element label --> atom indices of the element
+    orbitals: (bool) Determines whether or not to keep the orbitals
+    spd: (bool) Determines whether or not to sum the s, p, and d orbitals
+
+    Outputs:
+    ----------
+    band_dict: (dict[str][pd.DataFrame]) Dictionary that contains the summed
+        weights for each element in the band.
+    """
+
+    band_dict = {}
+
+    for (element, atoms) in element_index.items():
+        # (nkpoints, 9)
+        summed = proj_band[atoms].sum(axis=0)
+        if orbitals:
+            if spd:
+                band_dict[element] = pd.DataFrame({
+                    's': summed[:, 0],
+                    'p': summed[:, 1:4].sum(axis=1),
+                    'd': summed[:, 4:9].sum(axis=1),
+                })
+            else:
+                band_dict[element] = pd.DataFrame(summed)
+        else:
+            band_dict[element] = summed.sum(axis=1)
+
+    return band_dict
+
+
+def _save_atomic(filename, save, *args, **kwargs):
+    """
+    This function writes a cache file by saving it to a temporary file in the
+    same folder and then moving it into place with os.replace. Instances that
+    still have the old file memory mapped keep reading the old data instead
+    of the file being truncated or overwritten underneath them.
+
+    Inputs:
+    ----------
+    filename: (str) Path of the file to write
+    save: (function) Function such as np.save that writes to an open file,
+        called as save(file, *args, **kwargs)
+    """
+
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or '.',
+        suffix='.tmp'
+    )
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            save(f, *args, **kwargs)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+@njit(cache=True)
+def _sum_atoms(proj, atoms_idx):
+    """
+    This function sums the orbital weights of the selected atoms for every
+    band and kpoint. It is compiled with numba so the loops run in native
+    code instead of creating an intermediate copy of the selected atoms.
+    The kernel is deliberately serial: numba's parallel threading layer
+    leaves worker threads alive, and forking the multiprocessing pool used
+    by sum_elements while they exist deadlocks the interpreter at exit.
+
+    Inputs:
+    ----------
+    proj: (np.ndarray) Projected weights with the shape
+        (nbands, natoms, nkpoints, 9)
+    atoms_idx: (np.ndarray) Indices of the selected atoms
+
+    Outputs:
+    ----------
+    summed: (np.ndarray) Summed weights with the shape
+        (nbands, len(atoms_idx), nkpoints)
+    """
+
+    nbands = proj.shape[0]
+    nkpoints = proj.shape[2]
+    summed = np.empty((nbands, atoms_idx.size, nkpoints), dtype=proj.dtype)
+
+    for j in range(nbands):
+        for a in range(atoms_idx.size):
+            for k in range(nkpoints):
+                summed[j, a, k] = proj[j, atoms_idx[a], k, :].sum()
+
+    return summed
+
+
+class FastBSVasprun:
+    """
+    This class is a lightweight replacement for pymatgen's BSVasprun that only
+    reads the parts of the vasprun.xml file needed for band structures. The
+    file is streamed with iterparse and every element outside of the kpoints,
+    eigenvalues and projected sections is cleared as soon as it is read, so
+    the full xml tree is never held in memory.
+    """
+
+    def __init__(self, filename, parse_projected_eigen=False):
+        """
+        Initialize parameters upon the generation of this class
+
+        Inputs:
+        ----------
+        filename: (str) Path to the vasprun.xml file
+        parse_projected_eigen: (bool) Determines whether or not to parse the
+            projected eigenvalues
+        """
+
+        self.eigenvalues = None
+        self.projected_eigenvalues = None
+        self.efermi = None
+        self.actual_kpoints = None
+
+        sections = ['kpoints', 'eigenvalues', 'projected']
+        # VASP 6.3+ writes the results on the KPOINTS_OPT grid in these
+        # sections, which contain their own kpoints, eigenvalues and fermi
+        # level that must not replace the ones of the main grid.
+        kpoints_opt_sections = [
+            'eigenvalues_kpoints_opt',
+            'projected_kpoints_opt',
+            'dos_kpoints_opt',
+        ]
+        open_sections = []
+
+        for (event, elem) in etree.iterparse(filename, events=('start', 'end')):
+            tag = elem.tag
+
+            if tag == 'dos' and elem.get('comment') == 'kpoints_opt':
+                tag = 'dos_kpoints_opt'
+
+            if event == 'start':
+                if tag in sections or tag in kpoints_opt_sections:
+                    open_sections.append(tag)
+                continue
+
+            if open_sections and open_sections[-1] == tag:
+                open_sections.pop()
+
+            if any(section in kpoints_opt_sections for section in open_sections):
+                continue
+
+            if tag == 'kpoints' and self.actual_kpoints is None:
+                kpoints = elem.find("varray[@name='kpointlist']").findall('v')
+                self.actual_kpoints = self._parse_rows(
+                    kpoints, (len(kpoints), 3))
+            elif tag == 'eigenvalues' and 'projected' not in open_sections:
+                self.eigenvalues = self._parse_eigen(elem)
+            elif tag == 'projected' and parse_projected_eigen:
+                self.projected_eigenvalues = self._parse_projected_eigen(elem)
+            elif tag == 'i' and elem.get('name') == 'efermi':
+                self.efermi = float(elem.text)
+
+            if not open_sections:
+                elem.clear()
+
+    @staticmethod
+    def _parse_rows(rows, shape):
+        """
+        Converts the text of a list of <r> or <v> elements into an array of
+        the given shape. VASP writes fields that overflow their format as
+        asterisks, these are read as NaN the same way pymatgen does.
+        """
+
+        text = ' '.join(row.text for row in rows)
+
+        if '*' in text:
+            text = re.sub(r'\S*\*\S*', 'nan', text)
+
+        # np.fromstring converts without creating a Python object per value,
+        # a malformed field truncates the result which the size check catches
+        values = np.fromstring(text, sep=' ')
+
+        if values.size != np.prod(shape):
+            raise ValueError(
+                f'Expected {np.prod(shape)} values with the shape {shape} in '
+                f'vasprun.xml but found {values.size}'
+            )
+
+        return values.reshape(shape)
+
+    @staticmethod
+    def _spin_sets(array):
+        """
+        Maps the spin channel <set> elements of an <array> to pymatgen spins
+        using the number in their comment ("spin 1", "spin2", ...). Non
+        collinear calculations write 4 channels (total, mx, my, mz), in which
+        case only the first one is kept, the same way pymatgen does.
+        """
+
+        channels = {
+            int(re.search(r'\d+', spin_set.get('comment')).group()): spin_set
+            for spin_set in array.find('set').findall('set')
+        }
+
+        if len(channels) > 2:
+            return {Spin.up: channels[1]}
+
+        return {
+            {1: Spin.up, 2: Spin.down}[channel]: spin_set
+            for (channel, spin_set) in channels.items()
+        }
+
+    def _parse_eigen(self, elem):
+        """
+        Parses an <eigenvalues> element into a dictionary of the form:
+        spin --> array of shape (nkpoints, nbands, 2)
+        """
+
+        eigenvalues = {}
+        spin_sets = self._spin_sets(elem.find('array'))
+
+        for (spin, spin_set) in spin_sets.items():
+            kpoint_sets = spin_set.findall('set')
+            nbands = len(kpoint_sets[0].findall('r'))
+            eigenvalues[spin] = self._parse_rows(
+                [r for kpoint_set in kpoint_sets for r in kpoint_set.findall('r')],
+                (len(kpoint_sets), nbands, 2)
+            )
+
+        return eigenvalues
+
+    def _parse_projected_eigen(self, elem):
+        """
+        Parses a <projected> element into a dictionary of the form:
+        spin --> array of shape (nkpoints, nbands, natoms, norbitals)
+        """
+
+        projected_eigenvalues = {}
+        array = elem.find('array')
+        norbitals = len(array.findall('field'))
+        spin_sets = self._spin_sets(array)
+
+        for (spin, spin_set) in spin_sets.items():
+            kpoint_sets = spin_set.findall('set')
+            band_sets = kpoint_sets[0].findall('set')
+            natoms = len(band_sets[0].findall('r'))
+            projected_eigenvalues[spin] = self._parse_rows(
+                [r for kpoint_set in kpoint_sets
+                 for band_set in kpoint_set.findall('set')
+                 for r in band_set.findall('r')],
+                (len(kpoint_sets), len(band_sets), natoms, norbitals)
+            )
+
+        return projected_eigenvalues
 
 
 class BandStructure:
@@ -31,23 +298,32 @@ class BandStructure:
         spin: (str) Choose which spin direction to parse. ('up' or 'down')
         """
 
-        self.vasprun = BSVasprun(
-            f'{folder}/vasprun.xml',
-            parse_projected_eigen=projected
-        )
+        self.folder = folder
+        self.projected = projected
+        self.vasprun = self.load_vasprun()
         self.poscar = Poscar.from_file(
             f'{folder}/POSCAR',
             check_for_POTCAR=False,
             read_velocities=False
         )
-        self.projected = projected
+        self.element_list = np.repeat(
+            np.asarray(self.poscar.site_symbols),
+            self.poscar.natoms
+        )
+        self.element_index = {
+            element: np.where(self.element_list == element)[0]
+            for element in self.poscar.site_symbols
+        }
         self.hse = hse
         self.kpath = kpath
         self.n = n
-        self.folder = folder
         self.spin = 'up'
         self.spin_dict = {'up': Spin.up, 'dowm': Spin.down}
         self.bands_dict = self.load_bands()
+        self.bands_arr = np.stack(
+            [self.bands_dict[band] for band in self.bands_dict])
+        self.wave_vec_arr = np.tile(
+            np.arange(self.bands_arr.shape[1]), self.bands_arr.shape[0])
         self.color_dict = {
             0: '#FF0000',
             1: '#0000FF',
@@ -60,12 +336,124 @@ class BandStructure:
             8: '#40BAF2',
         }
 
+        self._projected_dict = None
+
         if projected:
-            self.projected_dict = self.load_projected_bands()
+            self.proj = self.load_projected_bands()
 
         if not hse:
             self.kpoints = Kpoints.from_file(f'{folder}/KPOINTS')
 
+    def load_vasprun(self):
+        """
+        This function parses the vasprun.xml file and caches the eigenvalues,
+        fermi energy and kpoints in vaspvis_cache.npz inside the folder. The
+        projected eigenvalues of each spin are cached separately in
+        vaspvis_projected_<spin>.npy as float32 with the shape
+        (nbands, natoms, nkpoints, 9) and are opened as memory maps, so only
+        the bands and atoms that are used get read from the disk. If the
+        cache is newer than the vasprun.xml file it is loaded instead so the
+        vasprun.xml file is only parsed once.
+
+        Output:
+        ----------
+        vasprun: (SimpleNamespace) Object containing the eigenvalues,
+            projected_eigenvalues, efermi and actual_kpoints of the calculation
+        """
+
+        vasprun_file = f'{self.folder}/vasprun.xml'
+        cache_file = f'{self.folder}/vaspvis_cache.npz'
+        vasprun_mtime = os.path.getmtime(vasprun_file)
+
+        def projected_file(spin):
+            return f'{self.folder}/vaspvis_projected_{spin}.npy'
+
+        def is_fresh(filename):
+            return os.path.isfile(filename) and \
+                os.path.getmtime(filename) >= vasprun_mtime
+
+        if is_fresh(cache_file):
+            with np.load(cache_file) as cache:
+                spins = cache['spins']
+                if not self.projected or \
+                        all(is_fresh(projected_file(spin)) for spin in spins):
+                    eigenvalues = {
+                        Spin[spin]: cache[f'eigenvalues_{spin}'] for spin in spins
+                    }
+                    efermi = float(cache['efermi'])
+                    actual_kpoints = cache['kpoints']
+
+                    if self.projected:
+                        projected_eigenvalues = {
+                            Spin[spin]: np.load(
+                                projected_file(spin), mmap_mode='r')
+                            for spin in spins
+                        }
+                    else:
+                        projected_eigenvalues = None
+
+                    return SimpleNamespace(
+                        eigenvalues=eigenvalues,
+                        projected_eigenvalues=projected_eigenvalues,
+                        efermi=efermi,
+                        actual_kpoints=actual_kpoints,
+                    )
+
+        vasprun = FastBSVasprun(
+            vasprun_file,
+            parse_projected_eigen=self.projected
+        )
+
+        eigenvalues = {
+            spin: np.asarray(eigenvalues)
+            for (spin, eigenvalues) in vasprun.eigenvalues.items()
+        }
+
+        if self.projected:
+            # (nkpoints, nbands, natoms, 9) --> (nbands, natoms, nkpoints, 9)
+            # The weights only set the size of the scatter points, so float32
+            # is plenty and halves the memory traffic of every reduction.
+            projected_eigenvalues = {
+                spin: np.ascontiguousarray(
+                    np.asarray(projected_eigenvalues).transpose(1, 2, 0, 3),
+                    dtype=np.float32
+                )
+                for (spin, projected_eigenvalues)
+                in vasprun.projected_eigenvalues.items()
+            }
+        else:
+            projected_eigenvalues = None
+
+        try:
+            if self.projected:
+                for (spin, proj) in projected_eigenvalues.items():
+                    _save_atomic(projected_file(spin.name), np.save, proj)
+                    projected_eigenvalues[spin] = np.load(
+                        projected_file(spin.name), mmap_mode='r')
+
+            _save_atomic(
+                cache_file,
+                np.savez_compressed,
+                efermi=vasprun.efermi,
+                kpoints=np.asarray(vasprun.actual_kpoints),
+                spins=[spin.name for spin in eigenvalues],
+                **{
+                    f'eigenvalues_{spin.name}': eigenvalues[spin]
+                    for spin in eigenvalues
+                }
+            )
+        except OSError:
+            # The cache is only an optimization, so a read only folder
+            # should not stop the band structure from loading.
+            pass
+
+        return SimpleNamespace(
+            eigenvalues=eigenvalues,
+            projected_eigenvalues=projected_eigenvalues,
+            efermi=vasprun.efermi,
+            actual_kpoints=np.asarray(vasprun.actual_kpoints),
+        )
+
     def load_bands(self):
         """
         This function is used to load eigenvalues from the vasprun.xml
@@ -89,74 +477,69 @@ class BandStructure:
             eigenvalues = self.vasprun.eigenvalues[self.spin_dict[spin]]
 
         efermi = self.vasprun.efermi
-        nkpoints = len(eigenvalues)
-        nbands = len(eigenvalues[0])
+        eigenvalues = np.asarray(eigenvalues)[:, :, 0] - efermi
+        nbands = eigenvalues.shape[1]
 
-        bands_dict = {f'band{i+1}': [] for i in range(nbands)}
-
-        for i in range(nkpoints):
-            for j in range(nbands):
-                bands_dict[f'band{j+1}'].append(
-                    eigenvalues[i][j][0] - efermi
-                )
+        bands_dict = {
+            f'band{j+1}': eigenvalues[:, j] for j in range(nbands)
+        }
 
         return bands_dict
 
     def load_projected_bands(self):
         """
         This function loads the project weights of the orbitals in each band
-        from vasprun.xml into a dictionary of the form:
-        band index --> atom index --> weights of orbitals
+        from vasprun.xml into a single array of the form:
+        band index --> atom index --> kpoint index --> weights of orbitals
 
         Output:
         ----------
-        projected_dict: (dict([str][int][pd.DataFrame])) Dictionary containing the
-            projected weights of all orbitals on each atom for each band.
+        proj: (np.ndarray) Array of shape (nbands, natoms, nkpoints, 9) containing
+            the projected weights of all orbitals on each atom for each band.
         """
 
         spin = self.spin
 
+        # (nbands, natoms, nkpoints, 9)
+        proj = self.vasprun.projected_eigenvalues[self.spin_dict[spin]]
+
         if self.hse:
             kpoints_band = self.n * (len(self.kpath) - 1)
-            projected_eigenvalues = self.vasprun.projected_eigenvalues[
-                self.spin_dict[spin]
-            ][-1 * kpoints_band:]
-        else:
-            projected_eigenvalues = self.vasprun.projected_eigenvalues[
-                self.spin_dict[spin]
-            ]
+            proj = proj[:, :, -1 * kpoints_band:]
 
-        poscar = Poscar.from_file(
-            f'{self.folder}/POSCAR',
-            check_for_POTCAR=False,
-            read_velocities=False
-        )
-        spin = self.spin
-        natoms = np.sum(poscar.natoms)
-        nkpoints = len(projected_eigenvalues)
-        nbands = len(projected_eigenvalues[0])
-
-        projected_dict = {f'band{i+1}':
-                          {atom: np.zeros(9) for atom in range(natoms)}
-                          for i in range(nbands)}
-
-        for i in range(nkpoints):
-            for j in range(nbands):
-                band = f'band{j+1}'
-                for atom in range(natoms):
-                    orbital_weights = projected_eigenvalues[i][j][atom]
-                    projected_dict[band][atom] = np.vstack([
-                        projected_dict[band][atom],
-                        orbital_weights
-                    ])
-
-        for band in projected_dict:
-            for atom in projected_dict[band]:
-                projected_dict[band][atom] = pd.DataFrame(
-                    projected_dict[band][atom][1:]
-                )
+        natoms = np.sum(self.poscar.natoms)
 
-        return projected_dict
+        if proj.shape[1] != natoms:
+            raise ValueError(
+                f'vasprun.xml contains {proj.shape[1]} atoms but the POSCAR '
+                f'contains {natoms} atoms'
+            )
+
+        return proj
+
+    @property
+    def projected_dict(self):
+        """
+        Dictionary view of the projected weights of the form:
+        band index --> atom index --> weights of orbitals
+        This is only built when it is first requested.
+
+        Output:
+        ----------
+        projected_dict: (dict([str][int][pd.DataFrame])) Dictionary containing the
+            projected weights of all orbitals on each atom for each band.
+        """
+
+        if self._projected_dict is None:
+            nbands, natoms = self.proj.shape[:2]
+            self._projected_dict = {
+                f'band{j+1}': {
+                    atom: pd.DataFrame(self.proj[j, atom])
+                    for atom in range(natoms)
+                } for j in range(nbands)
+            }
+
+        return self._projected_dict
 
     def sum_spd(self):
         """
@@ -166,27 +549,21 @@ class BandStructure:
 
         Outputs:
         ----------
-        spd_dict: (dict([str][pd.DataFrame])) Dictionary that contains the summed
-            weights for the s, p, and d orbitals for each band
+        spd_dict: (dict([str][np.ndarray])) Dictionary that contains the summed
+            weights for each band as an array of shape (nkpoints, 3) where the
+            columns are the s, p, and d orbitals
         """
 
-        spd_orbitals = {'s': [0], 'p': [1, 2, 3], 'd': [4, 5, 6, 7, 8]}
+        # (nbands, natoms, nkpoints, 9) --> (nbands, nkpoints, 9)
+        summed = self.proj.sum(axis=1)
 
-        spd_dict = {band: np.nan for band in self.projected_dict}
+        spd = np.stack([
+            summed[:, :, 0],
+            summed[:, :, 1:4].sum(axis=-1),
+            summed[:, :, 4:9].sum(axis=-1),
+        ], axis=-1)
 
-        for band in self.projected_dict:
-            atom_list = [
-                self.projected_dict[band][atom] for atom in self.projected_dict[band]]
-            spd_dict[band] = reduce(
-                lambda x, y: x.add(y, fill_value=0), atom_list
-            )
-
-        for band in spd_dict:
-            df = spd_dict[band]
-            spd_dict[band]['s'] = df[0]
-            spd_dict[band]['p'] = df[1] + df[2] + df[3]
-            spd_dict[band]['d'] = df[4] + df[5] + df[6] + df[7] + df[8]
-            spd_dict[band] = spd_dict[band].drop(columns=range(9))
+        spd_dict = {f'band{j+1}': spd[j] for j in range(spd.shape[0])}
 
         return spd_dict
 
@@ -215,20 +592,15 @@ class BandStructure:
             weights of the selected orbitals.
         """
 
-        orbital_dict = {band: np.nan for band in self.projected_dict}
+        columns = [orbital for orbital in range(9) if orbital in orbitals]
 
-        for band in self.projected_dict:
-            atom_list = [
-                self.projected_dict[band][atom] for atom in self.projected_dict[band]]
-            orbital_dict[band] = reduce(
-                lambda x, y: x.add(y, fill_value=0), atom_list
-            )
+        # (nbands, natoms, nkpoints, 9) --> (nbands, nkpoints, len(columns))
+        summed = self.proj[..., columns].sum(axis=1)
 
-        for band in orbital_dict:
-            df = orbital_dict[band]
-            for col in df.columns.tolist():
-                if sum(np.isin(orbitals, col)) == 0:
-                    orbital_dict[band] = orbital_dict[band].drop(columns=col)
+        orbital_dict = {
+            f'band{j+1}': pd.DataFrame(summed[j], columns=columns)
+            for j in range(summed.shape[0])
+        }
 
         return orbital_dict
 
@@ -249,17 +621,35 @@ class BandStructure:
             weights of the selected atoms.
         """
 
-        projected_dict = self.projected_dict
-        atoms_dict = {band: np.nan for band in projected_dict}
+        nbands, natoms, nkpoints = self.proj.shape[:3]
+
+        # Repeated atoms would create duplicate DataFrame columns
+        atoms = list(dict.fromkeys(atoms))
+
+        for atom in atoms:
+            if not 0 <= atom < natoms:
+                raise IndexError(
+                    f'Atom index {atom} is out of range for a structure '
+                    f'with {natoms} atoms'
+                )
+
+        # The numba kernel takes about a second to compile on its first call,
+        # so it is only worth it when the copy made by fancy indexing the
+        # selected atoms would be large.
+        if nbands * len(atoms) * nkpoints * 9 < 2**24:
+            # (nbands, len(atoms), nkpoints)
+            summed = self.proj[:, atoms].sum(axis=-1)
+        else:
+            summed = _sum_atoms(self.proj, np.asarray(atoms, dtype=np.int64))
 
-        for band in projected_dict:
-            atom_dict = {atom: projected_dict[band][atom].sum(
-                axis=1) for atom in atoms}
-            atoms_dict[band] = pd.DataFrame.from_dict(atom_dict)
+        atoms_dict = {
+            f'band{j+1}': pd.DataFrame(summed[j].T, columns=atoms)
+            for j in range(summed.shape[0])
+        }
 
         return atoms_dict
 
-    def sum_elements(self, elements, orbitals=False, spd=False):
+    def sum_elements(self, elements, orbitals=False, spd=False, n_cpus=1):
         """
         This function sums the weights of the orbitals of specific elements within the
         calculated structure and returns a dictionary of the form:
@@ -274,6 +664,8 @@ class BandStructure:
         orbitals: (bool) Determines whether or not to inclue orbitals or not
             (True = keep orbitals, False = sum orbitals together )
         spd: (bool) Determines whether or not to sum the s, p, and d orbitals
+        n_cpus: (int) Number of processes used to sum the bands. The bands are
+            only split between processes when there are many of them.
 
 
         Outputs:
@@ -282,46 +674,31 @@ class BandStructure:
             weights for each orbital for a given element in the structure.
         """
 
-        poscar = self.poscar
-        natoms = poscar.natoms
-        symbols = poscar.site_symbols
-        projected_dict = self.projected_dict
+        nbands = self.proj.shape[0]
+
+        element_index = {
+            element: self.element_index[element] for element in elements
+        }
 
-        element_list = np.hstack(
-            [[symbols[i] for j in range(natoms[i])]
-             for i in range(len(symbols))]
+        reduce_band = partial(
+            _reduce_band,
+            element_index=element_index,
+            orbitals=orbitals,
+            spd=spd,
         )
 
+        # The pool only pays for its startup and pickling cost when there
+        # are enough bands to split between the workers.
+        if n_cpus > 1 and nbands >= 16 * n_cpus:
+            with Pool(n_cpus) as pool:
+                band_dicts = pool.map(reduce_band, self.proj)
+        else:
+            band_dicts = [reduce_band(proj_band) for proj_band in self.proj]
+
         element_dict = {
-            band: {element: [] for element in elements} for band in projected_dict
+            f'band{j+1}': band_dict for (j, band_dict) in enumerate(band_dicts)
         }
 
-        for band in projected_dict:
-            band_df = pd.DataFrame()
-            for element in elements:
-                element_index = np.where(element_list == element)[0]
-                df = pd.concat(
-                    [projected_dict[band][i] for i in element_index],
-                    axis=1
-                )
-
-                if orbitals:
-                    element_dict[band][element] = df.groupby(
-                        by=df.columns,
-                        axis=1
-                    ).sum()
-                    if spd:
-                        df = element_dict[band][element]
-                        element_dict[band][element]['s'] = df[0]
-                        element_dict[band][element]['p'] = df[1] + \
-                            df[2] + df[3]
-                        element_dict[band][element]['d'] = df[4] + \
-                            df[5] + df[6] + df[7] + df[8]
-                        element_dict[band][element] = element_dict[band][element].drop(
-                            columns=range(9))
-                else:
-                    element_dict[band][element] = df.sum(axis=1).tolist()
-
         return element_dict
 
     def get_kticks(self, ax):
@@ -334,18 +711,25 @@ class BandStructure:
         ax: (matplotlib.pyplot.axis) Axis to append the tick labels
         """
 
-        high_sym_points = self.kpoints.kpts
+        high_sym_points = np.asarray(self.kpoints.kpts)
         kpts_labels = np.array([f'${k}$' for k in self.kpoints.labels])
-        all_kpoints = self.vasprun.actual_kpoints
-
-        index = [0]
-        for i in range(len(high_sym_points) - 2):
-            if high_sym_points[i + 2] != high_sym_points[i + 1]:
-                index.append(i)
-        index.append(len(high_sym_points) - 1)
-
-        kpts_loc = np.isin(all_kpoints, high_sym_points).all(1)
-        kpoints_index = np.where(kpts_loc == True)[0]
+        all_kpoints = np.asarray(self.vasprun.actual_kpoints)
+
+        segment_change = np.any(
+            high_sym_points[2:] != high_sym_points[1:-1], axis=1)
+        index = np.concatenate((
+            [0],
+            np.where(segment_change)[0],
+            [len(high_sym_points) - 1],
+        ))
+
+        # Compare whole rows so a kpoint only matches when all three of its
+        # coordinates belong to the same high symmetry point.
+        kpts_loc = np.isclose(
+            all_kpoints[:, np.newaxis, :],
+            high_sym_points[np.newaxis, :, :],
+        ).all(axis=2).any(axis=1)
+        kpoints_index = np.where(kpts_loc)[0]
 
         kpts_labels = kpts_labels[index]
         kpoints_index = list(kpoints_index[index])
@@ -390,24 +774,28 @@ class BandStructure:
         linewidth: (float) Line width of the band structure lines
         """
 
-        wave_vector = range(len(self.bands_dict['band1']))
+        nbands, nkpoints = self.bands_arr.shape
 
-        for band in self.bands_dict:
-            band_values = self.bands_dict[band]
-            ax.plot(
-                wave_vector,
-                band_values,
-                color=color,
-                linewidth=linewidth,
-                zorder=0,
-            )
+        # A NaN column at the end of every band breaks the line, so all of
+        # the bands can be drawn as a single Line2D artist.
+        wave_vector = np.tile(np.append(np.arange(nkpoints), np.nan), nbands)
+        band_values = np.hstack(
+            [self.bands_arr, np.full((nbands, 1), np.nan)]).ravel()
+
+        ax.plot(
+            wave_vector,
+            band_values,
+            color=color,
+            linewidth=linewidth,
+            zorder=0,
+        )
 
         if self.hse:
             self.get_kticks_hse(ax=ax, kpath=self.kpath, n=self.n)
         else:
             self.get_kticks(ax=ax)
 
-        plt.xlim(0, len(wave_vector)-1)
+        plt.xlim(0, nkpoints-1)
 
     def plot_spd(self, ax, scale_factor=5, order=['s', 'p', 'd'], color_dict=None):
         """
@@ -442,21 +830,17 @@ class BandStructure:
 
         self.plot_plain(ax, linewidth=0.5)
 
-        plot_df = pd.DataFrame(columns=['s', 'p', 'd'])
-        plot_band = []
-        plot_wave_vec = []
-
-        for band in spd_dict:
-            plot_df = plot_df.append(spd_dict[band])
-            plot_band.extend(self.bands_dict[band])
-            plot_wave_vec.extend(range(len(spd_dict[band])))
+        spd_index = {'s': 0, 'p': 1, 'd': 2}
+        plot_weights = np.concatenate([spd_dict[band] for band in spd_dict])
+        plot_band = self.bands_arr.ravel()
+        plot_wave_vec = self.wave_vec_arr
 
         for col in order:
             ax.scatter(
                 plot_wave_vec,
                 plot_band,
                 c=color_dict[col],
-                s=scale_factor * plot_df[col],
+                s=scale_factor * plot_weights[:, spd_index[col]],
                 zorder=1,
             )
 
@@ -481,23 +865,19 @@ class BandStructure:
         self.plot_plain(ax=ax, linewidth=0.75)
         # self.get_kticks(ax=ax)
 
-        projected_dict = self.projected_dict
-        wave_vector = range(len(self.bands_dict['band1']))
-
         if color_dict is None:
             color_dict = self.color_dict
 
-        for band in projected_dict:
-            for (i, atom_orbital_pair) in enumerate(atom_orbital_pairs):
-                atom = atom_orbital_pair[0]
-                orbital = atom_orbital_pair[1]
+        for (i, atom_orbital_pair) in enumerate(atom_orbital_pairs):
+            atom = atom_orbital_pair[0]
+            orbital = atom_orbital_pair[1]
 
-                ax.scatter(
-                    wave_vector,
-                    self.bands_dict[band],
-                    c=color_dict[i],
-                    s=scale_factor * projected_dict[band][atom][orbital]
-                )
+            ax.scatter(
+                self.wave_vec_arr,
+                self.bands_arr.ravel(),
+                c=color_dict[i],
+                s=scale_factor * self.proj[:, atom, :, orbital].ravel()
+            )
 
     def plot_orbitals(self, orbitals, ax, scale_factor=5, color_dict=None):
         """
@@ -523,14 +903,10 @@ class BandStructure:
         if color_dict is None:
             color_dict = self.color_dict
 
-        plot_df = pd.DataFrame(columns=orbitals)
-        plot_band = []
-        plot_wave_vec = []
-
-        for band in orbital_dict:
-            plot_df = plot_df.append(orbital_dict[band])
-            plot_band.extend(self.bands_dict[band])
-            plot_wave_vec.extend(range(len(orbital_dict[band])))
+        plot_df = pd.concat(
+            [orbital_dict[band] for band in orbital_dict], ignore_index=True)
+        plot_band = self.bands_arr.ravel()
+        plot_wave_vec = self.wave_vec_arr
 
         for orbital in orbitals:
             ax.scatter(
@@ -565,14 +941,10 @@ class BandStructure:
         if color_dict is None:
             color_dict = self.color_dict
 
-        plot_df = pd.DataFrame(columns=atoms)
-        plot_band = []
-        plot_wave_vec = []
-
-        for band in atom_dict:
-            plot_df = plot_df.append(atom_dict[band], ignore_index=True)
-            plot_band.extend(self.bands_dict[band])
-            plot_wave_vec.extend(range(len(atom_dict[band])))
+        plot_df = pd.concat(
+            [atom_dict[band] for band in atom_dict], ignore_index=True)
+        plot_band = self.bands_arr.ravel()
+        plot_wave_vec = self.wave_vec_arr
 
         for atom in atoms:
             ax.scatter(
@@ -583,7 +955,7 @@ class BandStructure:
                 zorder=1,
             )
 
-    def plot_elements(self, elements, ax, scale_factor=5, color_dict=None):
+    def plot_elements(self, elements, ax, scale_factor=5, color_dict=None, n_cpus=1):
         """
         This function plots the projected band structure on each element in
         the calculated structure. This is useful for supercells where the are
@@ -600,25 +972,25 @@ class BandStructure:
         color_dict: (dict[str][str]) This option allow the colors of each orbital
             specified. Should be in the form of:
             {'orbital index': <color>, 'orbital index': <color>, ...}
+        n_cpus: (int) Number of processes used to sum the element weights
 
         """
 
         self.plot_plain(ax=ax, linewidth=0.75)
 
-        element_dict = self.sum_elements(elements=elements, orbitals=False)
+        element_dict = self.sum_elements(
+            elements=elements, orbitals=False, n_cpus=n_cpus)
 
         if color_dict is None:
             color_dict = self.color_dict
 
-        plot_element = {element: [] for element in elements}
-        plot_band = []
-        plot_wave_vec = []
-
-        for band in element_dict:
-            plot_band.extend(self.bands_dict[band])
-            plot_wave_vec.extend(range(len(self.bands_dict[band])))
-            for element in elements:
-                plot_element[element].extend(element_dict[band][element])
+        plot_element = {
+            element: np.concatenate(
+                [element_dict[band][element] for band in element_dict])
+            for element in elements
+        }
+        plot_band = self.bands_arr.ravel()
+        plot_wave_vec = self.wave_vec_arr
 
         for (i, element) in enumerate(elements):
             ax.scatter(
@@ -629,7 +1001,7 @@ class BandStructure:
                 zorder=1,
             )
 
-    def plot_element_orbitals(self, elements, orbitals, ax, scale_factor=5, color_dict=None):
+    def plot_element_orbitals(self, elements, orbitals, ax, scale_factor=5, color_dict=None, n_cpus=1):
         """
         This function plots the projected band structure on each element in
         the calculated structure. This is useful for supercells where the are
@@ -646,39 +1018,40 @@ class BandStructure:
         color_dict: (dict[str][str]) This option allow the colors of each orbital
             specified. Should be in the form of:
             {'orbital index': <color>, 'orbital index': <color>, ...}
+        n_cpus: (int) Number of processes used to sum the element weights
 
         """
 
         self.plot_plain(ax=ax, linewidth=0.75)
 
-        element_dict = self.sum_elements(elements=elements, orbitals=True)
+        element_dict = self.sum_elements(
+            elements=elements, orbitals=True, n_cpus=n_cpus)
 
         if color_dict is None:
             color_dict = self.color_dict
 
-        plot_element = {element: pd.DataFrame(
-            columns=[range(9)]) for element in elements}
-        plot_band = []
-        plot_wave_vec = []
-
-        for band in element_dict:
-            plot_band.extend(self.bands_dict[band])
-            plot_wave_vec.extend(range(len(self.bands_dict[band])))
-            for element in elements:
-                plot_element[element] = plot_element[element].append(
-                    element_dict[band][element])
+        plot_element = {
+            element: pd.concat(
+                [element_dict[band][element] for band in element_dict],
+                ignore_index=True
+            ) for element in elements
+        }
+        plot_band = np.tile(self.bands_arr.ravel(), len(elements))
+        plot_wave_vec = np.tile(self.wave_vec_arr, len(elements))
 
-        for (i, element) in enumerate(elements):
-            for orbital in orbitals:
-                ax.scatter(
-                    plot_wave_vec,
-                    plot_band,
-                    c=color_dict[orbital],
-                    s=scale_factor * plot_element[element][orbital],
-                    zorder=1,
-                )
+        # One scatter per orbital with the weights of every element stacked
+        # end to end keeps the number of artists independent of the elements.
+        for orbital in orbitals:
+            ax.scatter(
+                plot_wave_vec,
+                plot_band,
+                c=color_dict[orbital],
+                s=scale_factor * np.concatenate(
+                    [plot_element[element][orbital] for element in elements]),
+                zorder=1,
+            )
 
-    def plot_element_spd(self, elements, ax, order=['s', 'p', 'd'], scale_factor=5, color_dict=None):
+    def plot_element_spd(self, elements, ax, order=['s', 'p', 'd'], scale_factor=5, color_dict=None, n_cpus=1):
         """
         This function plots the projected band structure on each element in
         the calculated structure. This is useful for supercells where the are
@@ -700,13 +1073,14 @@ class BandStructure:
         color_dict: (dict[str][str]) This option allow the colors of the s, p, and d
             orbitals to be specified. Should be in the form of:
             {'s': <s color>, 'p': <p color>, 'd': <d color>}
+        n_cpus: (int) Number of processes used to sum the element weights
 
         """
 
         self.plot_plain(ax=ax, linewidth=0.75)
 
         element_dict = self.sum_elements(
-            elements=elements, orbitals=True, spd=True)
+            elements=elements, orbitals=True, spd=True, n_cpus=n_cpus)
 
         if color_dict is None:
             color_dict = {
@@ -715,27 +1089,26 @@ class BandStructure:
                 'd': self.color_dict[2],
             }
 
-        plot_element = {element: pd.DataFrame(
-            columns=['s', 'p', 'd']) for element in elements}
-        plot_band = []
-        plot_wave_vec = []
-
-        for band in element_dict:
-            plot_band.extend(self.bands_dict[band])
-            plot_wave_vec.extend(range(len(self.bands_dict[band])))
-            for element in elements:
-                plot_element[element] = plot_element[element].append(
-                    element_dict[band][element])
+        plot_element = {
+            element: pd.concat(
+                [element_dict[band][element] for band in element_dict],
+                ignore_index=True
+            ) for element in elements
+        }
+        plot_band = np.tile(self.bands_arr.ravel(), len(elements))
+        plot_wave_vec = np.tile(self.wave_vec_arr, len(elements))
 
-        for (i, element) in enumerate(elements):
-            for orbital in order:
-                ax.scatter(
-                    plot_wave_vec,
-                    plot_band,
-                    c=color_dict[orbital],
-                    s=scale_factor * plot_element[element][orbital],
-                    zorder=1,
-                )
+        # One scatter per orbital with the weights of every element stacked
+        # end to end keeps the number of artists independent of the elements.
+        for orbital in order:
+            ax.scatter(
+                plot_wave_vec,
+                plot_band,
+                c=color_dict[orbital],
+                s=scale_factor * np.concatenate(
+                    [plot_element[element][orbital] for element in elements]),
+                zorder=1,
+            )
 
 
 def main():